@@ -4,16 +4,40 @@
 # bot_logic.py
 import asyncio
 import datetime
+import functools
 import logging
 import os
 import zipfile
 import json
 
+from dataclasses import dataclass, asdict
 from pathlib import Path
 import pytz
 import re
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 
+# orjson is optional; it serializes straight to bytes several times faster
+# than stdlib json. Fall back to json when it isn't installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_default(o):
+    """json fallback encoder for the datetime objects kept in MsgRecord."""
+    if isinstance(o, datetime.datetime):
+        return o.isoformat()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+if orjson is not None:
+    # orjson serializes datetime natively (RFC 3339) in C.
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+else:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, indent=2, ensure_ascii=False, default=_json_default).encode('utf-8')
+
 # Telethon Libraries
 from telethon import TelegramClient
 from telethon.tl.types import Message, Photo, ReactionCount # Import specific Telethon types
@@ -22,6 +46,22 @@ from telethon.utils import get_display_name
 
 logger = logging.getLogger(__name__)
 
+# Characters not allowed in archive filenames (e.g. from '@channelname' refs)
+_SAFE_CHAT_RE = re.compile(r'[^\w\-]+')
+
+# Token bucket shared by all Telegram API calls in this module. Proactively
+# pacing requests just under the soft limit keeps throughput steady, instead
+# of bursting until a FloodWaitError imposes a multi-second reactive sleep.
+_TG_LIMITER = AsyncLimiter(max_rate=25, time_period=1.0)
+
+# Server-side cap for messages.getHistory; one page = one RPC at this size.
+_PAGE_SIZE = 100
+
+# Raw chat reference (id or '@username') -> resolved InputPeer, kept at module
+# scope so repeat runs skip contacts.resolveUsername even if the shared client
+# below is torn down and recreated.
+_ENTITY_CACHE: dict = {}
+
 # --- Load Telethon Config ---
 # Load .env variables for Telethon credentials needed within this module
 load_dotenv()
@@ -43,24 +83,91 @@ except (ValueError, TypeError):
 
 # --- Helper Functions ---
 
-def get_last_full_day_range_utc(tz_name='UTC'):
-    """Calculates the UTC start and end datetime for the previous full day."""
+@dataclass(frozen=True, slots=True)
+class ProcessingConfig:
+    """Typed snapshot of the config values process_chat_history needs.
+
+    Built once at startup so per-chat invocations don't repeat the int
+    conversion, emoji splitting and dict indexing on identical input.
+    """
+    tz_name: str
+    min_reactions: int
+    download_dir: Path
+    archive_dir: Path
+    allowed_emojis: frozenset | None
+    download_concurrency: int = 8
+
+    @classmethod
+    def from_config(cls, config) -> "ProcessingConfig":
+        """Parses the raw config mapping (from main.load_configuration)."""
+        proc = config['Processing']
+        like_emojis_str = proc['like_emojis'].strip()
+        return cls(
+            tz_name=config['History']['timezone'],
+            min_reactions=int(proc['min_reactions_for_picture']),
+            download_dir=_ensure_dir(proc['download_dir']),
+            archive_dir=_ensure_dir(proc['archive_dir']),
+            allowed_emojis=frozenset(
+                e.strip() for e in like_emojis_str.split(',') if e.strip()
+            ) if like_emojis_str else None,
+            download_concurrency=int(proc.get('download_concurrency', 8)),
+        )
+
+
+@dataclass(slots=True)
+class MsgRecord:
+    """One processed message, as serialized into messages.json.
+
+    Slots avoid the per-instance dict (and its repeated key hashing) that the
+    previous literal-dict-per-message approach paid in the hot loop.
+    """
+    message_id: int
+    sender: str
+    sender_id: int | None
+    timestamp: datetime.datetime # formatted to ISO 8601 only at JSON dump time
+    text: str
+    reactions: int
+    photos: list
+
+
+
+_UTC = pytz.utc # Cached to avoid repeated attribute lookups in astimezone calls
+
+@functools.lru_cache(maxsize=32)
+def _get_tz(tz_name: str):
+    """Returns a cached pytz timezone object, falling back to UTC for unknown names.
+
+    pytz re-parses the zoneinfo file on every timezone() call, so cache the
+    (immutable) tzinfo objects instead of looking them up per invocation.
+    """
     try:
-        target_tz = pytz.timezone(tz_name)
+        return pytz.timezone(tz_name)
     except pytz.UnknownTimeZoneError:
         logger.warning(f"Unknown timezone '{tz_name}', falling back to UTC.")
-        target_tz = pytz.utc
+        return _UTC
+
+
+def _day_range_utc(day: datetime.date, tz) -> tuple[datetime.datetime, datetime.datetime]:
+    """Computes the [start, end) UTC datetimes covering one local calendar day.
+
+    Builds the midnight datetime directly instead of going through
+    datetime.combine + time.min, and keeps the end exclusive (start of the
+    next day) to match the `< end_dt_utc` filtering used when fetching.
+    """
+    start_local = tz.localize(datetime.datetime(day.year, day.month, day.day))
+    start_utc = start_local.astimezone(_UTC)
+    end_utc = (start_local + datetime.timedelta(days=1)).astimezone(_UTC)
+    return start_utc, end_utc
+
+
+def get_last_full_day_range_utc(tz_name='UTC'):
+    """Calculates the UTC start and end datetime for the previous full day."""
+    target_tz = _get_tz(tz_name)
 
     now_tz = datetime.datetime.now(target_tz)
     yesterday_tz = now_tz.date() - datetime.timedelta(days=1)
 
-    start_dt_tz = target_tz.localize(datetime.datetime.combine(yesterday_tz, datetime.time.min))
-    # End is exclusive for Telethon's offset_date, so use start of the next day
-    end_dt_tz = start_dt_tz + datetime.timedelta(days=1)
-
-    # Convert to UTC for Telethon API consistency and filtering
-    start_dt_utc = start_dt_tz.astimezone(pytz.utc)
-    end_dt_utc = end_dt_tz.astimezone(pytz.utc) # This is now the *start* of the target day
+    start_dt_utc, end_dt_utc = _day_range_utc(yesterday_tz, target_tz)
 
     logger.info(f"Target day: {yesterday_tz} ({tz_name})")
     logger.info(f"UTC Range: >= {start_dt_utc} and < {end_dt_utc}")
@@ -69,16 +176,65 @@ def get_last_full_day_range_utc(tz_name='UTC'):
     return start_dt_utc, end_dt_utc, yesterday_tz
 
 
+def _load_fetch_state(state_file: Path) -> dict:
+    """Reads the per-(chat, date) fetch cursor file, tolerating absence or corruption."""
+    try:
+        return json.loads(state_file.read_text())
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _save_fetch_state(state_file: Path, state_key: str, last_id: int):
+    """Records the highest message id fetched so far under the (chat, date) key."""
+    state = _load_fetch_state(state_file)
+    state[state_key] = last_id
+    try:
+        state_file.write_text(json.dumps(state))
+    except OSError as e:
+        logger.warning(f"Could not persist fetch state to {state_file}: {e}")
+
+
+def _clear_fetch_state(state_file: Path, state_key: str):
+    """Drops the cursor for a finished (chat, date) so re-runs fetch the full day."""
+    state = _load_fetch_state(state_file)
+    if state.pop(state_key, None) is not None:
+        try:
+            state_file.write_text(json.dumps(state))
+        except OSError as e:
+            logger.warning(f"Could not persist fetch state to {state_file}: {e}")
+
+
 async def get_chat_history_for_day_telethon(
     client: TelegramClient,
     chat_entity, # Can be chat ID, username, etc.
     start_dt_utc: datetime.datetime,
-    end_dt_utc: datetime.datetime):
+    end_dt_utc: datetime.datetime,
+    state_file: Path | None = None,
+    state_key: str | None = None):
     """
-    Fetches message history for a given period using Telethon.
+    Streams message history for a given period using Telethon.
     Iterates from oldest to newest within the approximate range.
+
+    Async generator: messages are yielded as they arrive so the caller can
+    process them while later pages are still in flight, instead of buffering
+    the whole day's Message objects in memory first.
+
+    When state_file/state_key are given, the highest fetched message id is
+    checkpointed after every page. Resume is strictly in-process: a FloodWait
+    interruption continues from the local cursor (via min_id), while a fresh
+    invocation always starts from the beginning of the day — a cursor left
+    over from a crashed run is discarded up front, because resuming from it
+    would rebuild the day's archive from only the post-cursor tail and
+    overwrite a more complete one. A key still present in the file therefore
+    marks a run that died mid-fetch; it is cleared on a clean finish.
     """
-    messages = []
+    fetched = 0
+    last_id = 0
+    if state_file is not None and state_key is not None:
+        stale_id = _load_fetch_state(state_file).get(state_key)
+        if stale_id is not None:
+            logger.warning(f"Discarding stale fetch cursor for '{state_key}' (id {stale_id}) from an interrupted run; refetching the full day.")
+            _clear_fetch_state(state_file, state_key)
     logger.info(f"Attempting to fetch Telethon history for chat '{chat_entity}' between {start_dt_utc} and {end_dt_utc}")
 
     try:
@@ -89,307 +245,442 @@ async def get_chat_history_for_day_telethon(
             logger.error("Telethon client is not authorized. Please run script interactively first.")
             # Handle authorization flow if needed (e.g., phone code, password)
             # This basic implementation assumes an existing, authorized session.
-            return [] # Cannot proceed without authorization
-
-        # Use iter_messages:
-        # - Set offset_date to the *end* of the period (exclusive). Messages *older* than this will start.
-        # - Use reverse=True to get messages oldest-first, making it easier to stop.
-        # - Set limit=None to fetch all messages in the range (Telethon handles batching).
-        async for message in client.iter_messages(
-            entity=chat_entity,
-            limit=None,
-            offset_date=start_dt_utc, # the meaning of `offset_date` parameters is reversed, so fetch messages *after* the start of the prev day (UTC)
-            reverse=True             # Start from older messages towards newer ones
-        ):
-            # client.iter_messages(entity=chat_entity, limit=None, offset_date=end_dt_utc, reverse=True)
-            # Message dates are timezone-aware (usually UTC)
-            msg_date_utc = message.date
-
-            # Check if the message date is within our *precise* desired range
-            if msg_date_utc >= end_dt_utc:
-                # This message is too new (shouldn't happen often with offset_date but good check)
-                continue
-            if msg_date_utc < start_dt_utc:
-                # This message is older than our start date. Since we reverse, we can stop.
-                # However, offset_date should handle this. Let's double check logic.
-                # If reverse=True, messages older than offset_date appear first.
-                # The iteration should ideally *start* near start_dt_utc.
-                # Let's filter strictly >= start_dt_utc
-                pass # Skip messages before the start time
-
-            # If we are here, the message is within the target day [start_dt_utc, end_dt_utc)
-            if start_dt_utc <= msg_date_utc < end_dt_utc:
-                messages.append(message)
-            elif msg_date_utc >= end_dt_utc:
-                # If somehow we get a message newer than our range end (after starting), stop.
-                break
-
-
-        logger.info(f"Fetched {len(messages)} messages using Telethon for chat '{chat_entity}' on target day.")
-        return messages
+            return # Cannot proceed without authorization
+
+        # Page explicitly with get_messages instead of iter_messages:
+        # - offset_date=start of the window plus reverse=True pages oldest-first
+        #   from the window start (the meaning of `offset_date` is reversed).
+        # - min_id carries the paging cursor, which doubles as the in-process
+        #   resume point after a FloodWait.
+        # - _PAGE_SIZE matches messages.getHistory's 100-message server cap, so
+        #   this costs the same number of RPCs as Telethon's internal batching
+        #   while letting us checkpoint at every page boundary.
+        while True:
+            try:
+                while True:
+                    async with _TG_LIMITER:
+                        batch = await client.get_messages(
+                            entity=chat_entity,
+                            limit=_PAGE_SIZE,
+                            offset_date=start_dt_utc,
+                            min_id=last_id,
+                            reverse=True
+                        )
+                    if not batch:
+                        break
+
+                    past_window_end = False
+                    for message in batch:
+                        # Message dates are timezone-aware (usually UTC).
+                        # Pages arrive in ascending date order, so the first
+                        # message at/after the window end means everything that
+                        # follows is newer: stop fetching further pages.
+                        if message.date >= end_dt_utc:
+                            past_window_end = True
+                            break
+
+                        # offset_date=start_dt_utc guarantees nothing older than
+                        # the window start is returned, so no lower-bound check.
+                        # History pages also contain MessageService items
+                        # (joins, pins, chat-photo edits); they must advance
+                        # the cursor so paging progresses, but are not real
+                        # messages — a chat-photo edit even exposes .photo and
+                        # would be archived as a message photo downstream.
+                        last_id = message.id
+                        if not isinstance(message, Message):
+                            continue
+                        fetched += 1
+                        yield message
+
+                    if state_file is not None:
+                        _save_fetch_state(state_file, state_key, last_id)
+                    # A short page is NOT a terminator: Telethon documents that
+                    # some channels return fewer messages than requested while
+                    # more remain, and get_messages drops MessageEmpty items
+                    # from the list. Only an empty page or a message past the
+                    # window end ends the fetch; when the day reaches the top
+                    # of the history that costs one extra (empty) RPC.
+                    if past_window_end:
+                        break
+                break # Finished the window cleanly
+
+            except FloodWaitError as e:
+                logger.warning(f"Telegram Flood Wait: sleeping {e.seconds} seconds, will resume after message id {last_id}.")
+                if state_file is not None:
+                    _save_fetch_state(state_file, state_key, last_id)
+                await asyncio.sleep(e.seconds + 1)
+                # Loop around and resume from last_id via min_id
+
+        if state_file is not None:
+            _clear_fetch_state(state_file, state_key)
+        logger.info(f"Fetched {fetched} messages using Telethon for chat '{chat_entity}' on target day.")
 
     except (ChatAdminRequiredError, UserNotParticipantError):
         logger.error(f"Cannot access chat '{chat_entity}'. Bot/User may lack permissions or not be a participant.")
-        return []
     except ValueError as e:
         logger.error(f"Invalid chat entity '{chat_entity}': {e}. Is the ID/username correct?")
-        return []
-    except FloodWaitError as e:
-        logger.warning(f"Telegram Flood Wait: Sleeping for {e.seconds} seconds.")
-        await asyncio.sleep(e.seconds + 1)
-        # Potentially retry logic could be added here, but for now, just return empty
-        return []
     except Exception as e:
         logger.exception(f"Unexpected error fetching Telethon history for chat '{chat_entity}': {e}")
-        return []
 
 
-def count_telethon_message_reactions(message: Message, like_emojis: list | None = None) -> int:
-    """Counts reactions on a Telethon message, optionally filtering."""
-    if not message.reactions or not message.reactions.results:
+def count_telethon_message_reactions(message: Message, allowed_emojis: frozenset | None = None) -> int:
+    """Counts reactions on a Telethon message, optionally filtering.
+
+    `allowed_emojis` is expected to be built once by the caller; rebuilding a
+    set per message is wasted work in the per-message loop.
+    """
+    reactions = message.reactions
+    # Most messages carry no reactions at all; bail out before touching
+    # .results in that common case.
+    if reactions is None or not reactions.results:
         return 0
 
-    total_count = 0
-    if like_emojis:
-        allowed_emojis_set = set(like_emojis)
-        for reaction_count in message.reactions.results:
-            # Accessing emoji requires checking the reaction type
-            # For ReactionCount, reaction is the emoji string itself
-            if isinstance(reaction_count, ReactionCount) and reaction_count.reaction in allowed_emojis_set:
-                total_count += reaction_count.count
-            # TODO: Handle ReactionCustomEmoji if needed
-    else:
-        # Count all reactions
-        for reaction_count in message.reactions.results:
-            total_count += reaction_count.count
-    return total_count
+    if allowed_emojis:
+        # Accessing emoji requires checking the reaction type
+        # For ReactionCount, reaction is the emoji string itself
+        # TODO: Handle ReactionCustomEmoji if needed
+        return sum(
+            rc.count for rc in reactions.results
+            if isinstance(rc, ReactionCount) and rc.reaction in allowed_emojis
+        )
+    # Count all reactions
+    return sum(rc.count for rc in reactions.results)
+
+
+@functools.lru_cache(maxsize=None)
+def _ensure_dir(path_str: str) -> Path:
+    """Creates the directory on first use and caches the resulting Path.
+
+    Output directories survive across invocations, so there is no point
+    re-stat'ing them for every chat processed.
+    """
+    path = Path(path_str)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _sender_name(sender_obj) -> str:
+    """Display name for a resolved sender entity, tolerating missing ones."""
+    return get_display_name(sender_obj) if sender_obj is not None else "Unknown Sender"
 
 
 async def download_telethon_file(client: TelegramClient, message_media, path: Path):
-    """Downloads media from a Telethon message to the specified path."""
+    """Downloads media from a Telethon message to the specified path.
+
+    The media body is fetched into memory and flushed with a single write in a
+    worker thread, so the event loop never blocks on disk I/O and each file
+    costs one write() instead of a chunked series of them.
+
+    Returns a structured (path, buf, exc) tuple: exceptions are captured
+    rather than raised, so one bad photo can't cancel sibling downloads and
+    the caller can report the failure against its message without any
+    result-order bookkeeping.
+    """
     try:
-        await client.download_media(message_media, file=path)
-        return path
+        try:
+            async with _TG_LIMITER:
+                buf = await client.download_media(message_media, file=bytes)
+        except FloodWaitError as e:
+            # With pacing from _TG_LIMITER and the caller's semaphore a
+            # FloodWait should be rare; honour it once instead of giving up.
+            logger.warning(f"Flood wait downloading media: sleeping {e.seconds} seconds, then retrying once.")
+            await asyncio.sleep(e.seconds + 1)
+            async with _TG_LIMITER:
+                buf = await client.download_media(message_media, file=bytes)
+        if buf is None:
+            return None, None, None
+        await asyncio.to_thread(path.write_bytes, buf)
+        return path, buf, None
     except Exception as e:
         # Catch specific Telethon errors if needed
         logger.exception(f"Unexpected error downloading media via Telethon: {e}")
-        return None
+        return None, None, e
+
+def _build_zip(zip_filepath: Path, messages_json_bytes: bytes, photo_entries: list):
+    """Builds the archive from in-memory buffers. Pure sync; run via asyncio.to_thread.
+
+    JPEGs are already compressed, so store them as-is; only messages.json
+    benefits from DEFLATE (level 1 is ~3x faster than the default on JSON
+    text for only a marginally larger archive).
+    """
+    with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_STORED) as zf:
+        for zip_path, buf in photo_entries:
+            zf.writestr(zip_path, buf)
+        zf.writestr("messages.json", messages_json_bytes,
+                    compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+
+# Shared Telethon client. The session is a SQLite file and Telethon does not
+# support two live clients on it at once — with max_parallel_jobs > 1 (or the
+# CLI --concurrency fan-out) per-job clients race on session writes and throw
+# "database is locked", potentially corrupting the session. One client is safe
+# for any number of coroutines on the same loop, so all jobs share this one.
+_telethon_client: TelegramClient | None = None
+_telethon_client_lock = asyncio.Lock()
+
+
+async def _get_telethon_client() -> TelegramClient:
+    """Returns the shared connected client, creating it on first use.
+
+    The first call may prompt interactively for login (same as the old
+    per-call `async with` did via start()); run the CLI once to authorize
+    before deploying as a service.
+    """
+    global _telethon_client
+    async with _telethon_client_lock:
+        if _telethon_client is None:
+            logger.info(f"Connecting Telethon client (Session: {SESSION_NAME})...")
+            client = TelegramClient(SESSION_NAME, API_ID, API_HASH, system_version="4.16.30-vxCUSTOM")
+            await client.start()
+            _telethon_client = client
+        elif not _telethon_client.is_connected():
+            await _telethon_client.connect()
+        return _telethon_client
+
+
+async def close_telethon_client():
+    """Disconnects the shared client (bot shutdown / CLI teardown)."""
+    global _telethon_client
+    if _telethon_client is not None:
+        await _telethon_client.disconnect()
+        _telethon_client = None
+
 
 # --- Main Processing Function ---
 
 async def process_chat_history(
     chat_id_or_username: int | str,
-    config: dict,
+    cfg: ProcessingConfig,
     target_date_override: datetime.date | None = None
-    ) -> tuple[str | None, list[str]]:
+    ) -> tuple[str | None, list[str], bytes | None]:
     """
     Fetches history using Telethon, processes messages, saves popular photos, and creates a zip archive.
 
     Returns:
-        tuple: (path_to_zip_file or None, list_of_saved_popular_photo_paths)
+        tuple: (path_to_zip_file or None, list_of_saved_popular_photo_paths,
+        messages_json_bytes or None). The JSON bytes are the exact payload
+        written into the archive, handed back so callers that upload them
+        don't have to reopen the zip and inflate messages.json again.
     """
     if not API_ID or not API_HASH:
         logger.error("Telethon API_ID or API_HASH not configured. Cannot process history.")
-        return None, []
+        return None, [], None
 
-    tz_name = config['History']['timezone']
-    min_reactions = int(config['Processing']['min_reactions_for_picture'])
-    download_dir = Path(config['Processing']['download_dir'])
-    archive_dir = Path(config['Processing']['archive_dir'])
-    like_emojis_str = config['Processing']['like_emojis'].strip()
-    like_emojis = [e.strip() for e in like_emojis_str.split(',') if e.strip()] if like_emojis_str else None
-
-    # Ensure output directories exist
-    download_dir.mkdir(parents=True, exist_ok=True)
-    archive_dir.mkdir(parents=True, exist_ok=True)
+    tz_name = cfg.tz_name
+    min_reactions = cfg.min_reactions
+    download_dir = cfg.download_dir
+    archive_dir = cfg.archive_dir
+    allowed_emojis = cfg.allowed_emojis
+    download_concurrency = cfg.download_concurrency
 
     # 1. Determine Date Range
     if target_date_override:
         target_day = target_date_override
-        try:
-            target_tz = pytz.timezone(tz_name)
-        except pytz.UnknownTimeZoneError:
-            target_tz = pytz.utc
-        start_dt_tz = target_tz.localize(datetime.datetime.combine(target_day, datetime.time.min))
-        end_dt_tz = start_dt_tz + datetime.timedelta(days=1) # Exclusive end
-        start_dt_utc = start_dt_tz.astimezone(pytz.utc)
-        end_dt_utc = end_dt_tz.astimezone(pytz.utc)
+        start_dt_utc, end_dt_utc = _day_range_utc(target_day, _get_tz(tz_name))
         logger.info(f"Processing specified date: {target_day} ({tz_name})")
     else:
         start_dt_utc, end_dt_utc, target_day = get_last_full_day_range_utc(tz_name)
 
-    # 2. Fetch History using Telethon
-    messages = []
-    telethon_client = TelegramClient(SESSION_NAME, API_ID, API_HASH, system_version="4.16.30-vxCUSTOM") # Use session name
-
+    # 2. Fetch History and Process using the shared Telethon client. One
+    # connect/auth handshake serves the history fetch and the photo downloads,
+    # and parallel jobs reuse the same connection instead of each opening a
+    # client over the same SQLite session file.
     try:
-        logger.info(f"Connecting Telethon client (Session: {SESSION_NAME})...")
-        # Context manager handles connect/disconnect
-        async with telethon_client as client:
-            messages = await get_chat_history_for_day_telethon(
-                client, chat_id_or_username, start_dt_utc, end_dt_utc
+        client = await _get_telethon_client()
+        # 3. Stream Messages and Find Popular Photos.
+        # Messages are consumed directly from the fetch generator, so the
+        # full day's Message objects are never held in memory at once and
+        # processing overlaps the network-bound history iteration.
+        processed_data = []
+        popular_photo_paths = []
+        photo_jobs = [] # (msg_id, media, local save path) triples
+        photo_details = {} # Store details needed after download
+        # One entity resolution per distinct sender rather than one
+        # get_sender() RPC per message (cache misses aside, a day with N
+        # messages from K senders needs only K lookups).
+        name_map = {} # sender_id -> display name
+
+        # Evaluated once so per-photo debug calls don't pay f-string/Path
+        # formatting costs when debug logging is off (the common case).
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+        # Archive path, also used to key the fetch-resume state file.
+        # Sanitize chat_id_or_username if it's a string like '@channelname'
+        safe_chat_ref = _SAFE_CHAT_RE.sub('_', str(chat_id_or_username))
+        zip_filename = f"chat_history_{safe_chat_ref}_{target_day}.zip"
+        zip_filepath = archive_dir / zip_filename
+
+        # Cap in-flight downloads so a photo-heavy day doesn't hammer the
+        # Telegram API (and trigger FloodWait) by launching everything at once.
+        download_sem = asyncio.Semaphore(download_concurrency)
+
+        async def _bounded_download(msg_id, media, path):
+            async with download_sem:
+                if media is None:
+                    # Already on disk from an earlier run of the same
+                    # chat/day (filenames are deterministic); reuse it
+                    # instead of re-downloading.
+                    buf = await asyncio.to_thread(path.read_bytes)
+                    return msg_id, path, buf, None
+                dl_path, buf, exc = await download_telethon_file(client, media, path)
+                return msg_id, dl_path, buf, exc
+
+        # target_day and chat id are invariant across the loop, so format
+        # the filename prefix once instead of per photo message.
+        name_prefix = None
+
+        # Resolve the chat reference once per process and reuse it for the
+        # fetch; one fewer resolveUsername RPC on every run after the first.
+        chat_entity = _ENTITY_CACHE.get(chat_id_or_username)
+        if chat_entity is None:
+            chat_entity = await client.get_input_entity(chat_id_or_username)
+            _ENTITY_CACHE[chat_id_or_username] = chat_entity
+
+        # get_chat_history_for_day_telethon filters out service messages
+        # at the source, so no per-item isinstance check is needed here.
+        async for msg in get_chat_history_for_day_telethon(
+            client, chat_entity, start_dt_utc, end_dt_utc,
+            state_file=archive_dir / "_state.json",
+            state_key=f"{safe_chat_ref}:{target_day}",
+        ):
+            sender_id = msg.sender_id
+            sender_name = name_map.get(sender_id)
+            if sender_name is None:
+                sender_obj = await msg.get_sender() # Need to fetch sender info
+                sender_name = _sender_name(sender_obj)
+                if sender_id is not None:
+                    name_map[sender_id] = sender_name
+            msg_text = msg.text or "" # Telethon uses msg.text for caption too
+            reaction_count = count_telethon_message_reactions(msg, allowed_emojis)
+
+            message_info = MsgRecord(
+                message_id=msg.id,
+                sender=sender_name,
+                sender_id=sender_id,
+                timestamp=msg.date,
+                text=msg_text,
+                reactions=reaction_count,
+                photos=[],
             )
-    except SessionPasswordNeededError:
-        logger.error("Telethon login failed: 2FA Password needed. Run script interactively first.")
-        # Cannot proceed without interactive password entry
-        return None, []
-    except Exception as e:
-        logger.exception(f"Failed to initialize or run Telethon client: {e}")
-        return None, []
-    # Client is automatically disconnected here by 'async with'
-
-    if not messages:
-        logger.warning(f"No messages found or fetched via Telethon for chat '{chat_id_or_username}' on {target_day}.")
-        # Decide if an empty zip should be created or just return
-        return None, []
-
-    # 3. Process Messages and Find Popular Photos
-    processed_data = []
-    popular_photo_paths = []
-    photo_download_tasks = []
-    photo_details = {} # Store details needed after download
-
-    logger.info(f"Processing {len(messages)} Telethon messages for chat '{chat_id_or_username}' on {target_day}...")
-    # Need the client again for downloads, let's reconnect briefly if needed, or structure differently
-    # Reconnecting for downloads might be inefficient. Better to do downloads within the 'async with' block?
-    # Let's restructure slightly to download within the fetch block or pass client
-
-    # --- Option: Re-Connect for downloads (simpler structure for now) ---
-    # This is less efficient but separates concerns slightly
-    download_client = TelegramClient(SESSION_NAME, API_ID, API_HASH, system_version="4.16.30-vxCUSTOM")
-    try:
-        async with download_client as dl_client:
-            if not await dl_client.is_user_authorized():
-                raise ValueError("Client not authorized for downloads") # Should be authorized already
 
-            for msg in messages:
-                if not isinstance(msg, Message):
-                    continue
-
-                timestamp = msg.date.isoformat()
-                sender_obj = await msg.get_sender() # Need to fetch sender info
-                sender_name = get_display_name(sender_obj) if sender_obj else "Unknown Sender"
-                msg_text = msg.text or "" # Telethon uses msg.text for caption too
-                reaction_count = count_telethon_message_reactions(msg, like_emojis)
-
-                message_info = {
-                    "message_id": msg.id,
-                    "sender": sender_name,
-                    "sender_id": sender_obj.id if sender_obj else None,
-                    "timestamp": timestamp,
-                    "text": msg_text,
-                    "reactions": reaction_count,
-                    "photos": []
-                }
-
-                if msg.photo and isinstance(msg.photo, Photo):
-                    # Telethon message.photo is the Photo object directly (largest size usually)
-                    photo_id = msg.photo.id
-                    # Create a unique-enough filename
-                    # Access hash might change, use photo_id and message_id
-                    photo_filename = f"{target_day}_{msg.chat_id}_{msg.id}_{photo_id}.jpg"
-                    photo_rel_path = f"photos/{photo_filename}"
-                    message_info["photos"].append({"photo_id": photo_id, "zip_path": photo_rel_path})
-
-                    if reaction_count >= min_reactions:
-                        local_save_path = download_dir / photo_filename
-                        # Schedule download task using the download_client
-                        photo_details[msg.id] = {"local_path": local_save_path, "zip_path": photo_rel_path, "media": msg.photo}
-                        # Use partial or lambda to pass arguments to the download coroutine
-                        task = download_telethon_file(dl_client, msg.photo, local_save_path)
-                        photo_download_tasks.append(task)
+            if msg.photo and isinstance(msg.photo, Photo):
+                # Telethon message.photo is the Photo object directly (largest size usually)
+                photo_id = msg.photo.id
+                # Create a unique-enough filename
+                # Access hash might change, use photo_id and message_id
+                if name_prefix is None:
+                    name_prefix = f"{target_day}_{msg.chat_id}_"
+                photo_filename = f"{name_prefix}{msg.id}_{photo_id}.jpg"
+                photo_rel_path = "photos/" + photo_filename
+                message_info.photos.append({"photo_id": photo_id, "zip_path": photo_rel_path})
+
+                if reaction_count >= min_reactions:
+                    local_save_path = download_dir / photo_filename
+                    photo_details[msg.id] = {"local_path": local_save_path, "zip_path": photo_rel_path, "media": msg.photo}
+                    if local_save_path.exists():
+                        # Deterministic names mean a re-run of the same
+                        # chat/day finds its photos already downloaded.
+                        photo_jobs.append((msg.id, None, local_save_path))
+                        logger.info(f"Photo msg {msg.id} already downloaded at {local_save_path}, reusing.")
+                    else:
+                        photo_jobs.append((msg.id, msg.photo, local_save_path))
                         logger.info(f"Photo msg {msg.id} has {reaction_count} reactions (>= {min_reactions}), scheduling download.")
 
-                processed_data.append(message_info)
-
-             # 4. Download Popular Photos Concurrently
-            downloaded_files_info = {}
-            if photo_download_tasks:
-                logger.info(f"Starting download of {len(photo_download_tasks)} popular photos via Telethon...")
-                results = await asyncio.gather(*photo_download_tasks, return_exceptions=True)
-
-                # Match results back to original info (this mapping is tricky with gather)
-                # Iterate through original details and check results based on path?
-                for msg_id, details in photo_details.items():
-                    local_path = details["local_path"]
-                    # Find the result corresponding to this path (or index if tasks kept order)
-                    # This assumes results maintain order, which gather *usually* does
-                    # A more robust way might involve returning (path, success_flag) from download
-                    idx = -1
-                    for i, task in enumerate(photo_download_tasks):
-                        # Inspecting the task details to match is hard. Assume order for now.
-                        # Or match based on the `local_path` passed to the task if possible.
-                        # Let's find the corresponding result by checking the target path
-                        # This relies on download_telethon_file returning the path on success
-                        potential_path = None
-                        task_coro = task # asyncio.gather returns results in order
-                        # Find the corresponding result by iterating through results
-                        # This is still clumsy. A better approach is needed if order isn't guaranteed
-                        # or if we need to correlate failures better.
-
-                    # Simplistic approach: Assume results are ordered and check for Exceptions
-                    try:
-                        # Find index based on details (requires tasks to be identifiable or ordered)
-                        # For now, let's just iterate results and log based on the path returned
-                        pass # This correlation needs improvement
-
-                    except Exception as gather_e:
-                        logger.error(f"Error processing download result: {gather_e}")
-
-
-                # Simpler logging based on successful results:
-                successful_downloads = [str(res) for res in results if isinstance(res, Path) and res.exists()]
-                failed_downloads = [str(details['local_path']) for i, details in enumerate(photo_details.values()) 
-                                    if isinstance(results[i], Exception)]
-
-                popular_photo_paths.extend(successful_downloads)
-                for path_str in successful_downloads:
-                    # Find corresponding details to store zip_path
-                    for msg_id_d, details_d in photo_details.items():
-                        if str(details_d["local_path"]) == path_str:
-                            downloaded_files_info[msg_id_d] = {"local_path": Path(path_str), "zip_path": details_d["zip_path"]}
-                            break
+            processed_data.append(message_info)
+            if len(processed_data) % 500 == 0:
+                logger.info(f"Processed {len(processed_data)} messages so far for chat '{chat_id_or_username}'...")
+
+        logger.info(f"Processed {len(processed_data)} Telethon messages for chat '{chat_id_or_username}' on {target_day}.")
+
+        # 4. Download Popular Photos Concurrently, collecting the image
+        # buffers destined for the archive as each download finishes.
+        photo_entries = [] # (zip path, bytes) pairs for _build_zip
+        try:
+            if photo_jobs:
+                logger.info(f"Starting download of {len(photo_jobs)} popular photos via Telethon...")
+                failed_downloads = []
+                # download_telethon_file swallows per-file errors and returns
+                # None, so the TaskGroup won't cancel siblings on a bad photo.
+                async with asyncio.TaskGroup() as tg:
+                    tasks = [
+                        tg.create_task(_bounded_download(msg_id, media, path))
+                        for msg_id, media, path in photo_jobs
+                    ]
+                    for fut in asyncio.as_completed(tasks):
+                        msg_id, local_path, buf, exc = await fut
+                        details = photo_details[msg_id]
+                        if buf is None:
+                            if exc is not None:
+                                logger.error(f"Download for msg {msg_id} ({details['local_path']}) failed: {exc}")
+                            failed_downloads.append(str(details["local_path"]))
+                            continue
+                        popular_photo_paths.append(str(local_path))
+                        # Straight from the in-memory buffer; no read-back
+                        # of the file just written to download_dir.
+                        photo_entries.append((details["zip_path"], buf))
+                        if debug_enabled:
+                            logger.debug(f"Queued photo for msg {msg_id} as {details['zip_path']} for the zip.")
 
                 if failed_downloads:
                     logger.warning(f"Failed to download {len(failed_downloads)} popular photos: {failed_downloads}")
+        except Exception as e:
+            # Still write the archive (messages.json plus whatever photos
+            # completed) even if the download phase falls over.
+            logger.exception(f"Error during Telethon download phase: {e}")
+
+        if not processed_data:
+            logger.warning(f"No messages found or fetched via Telethon for chat '{chat_id_or_username}' on {target_day}.")
+            return None, [], None
+
+        # 5. Build the archive off the event loop. Serializing and
+        # deflating messages.json plus writing MBs of photo buffers is
+        # blocking CPU+disk work; a worker thread keeps the loop free to
+        # handle other bot updates while the zip is assembled.
+        logger.info(f"Creating archive: {zip_filepath}")
+        messages_json_bytes = _dumps([asdict(r) for r in processed_data])
+        try:
+            await asyncio.to_thread(_build_zip, zip_filepath, messages_json_bytes, photo_entries)
+        except Exception as e:
+            logger.exception(f"Failed to create zip file {zip_filepath}: {e}")
+            # Return paths even if zip fails, but None for zip path
+            return None, popular_photo_paths, messages_json_bytes
 
+        logger.info(f"Successfully created archive: {zip_filepath}")
+        return str(zip_filepath), popular_photo_paths, messages_json_bytes
 
-    except ValueError as ve: # Catch the "Client not authorized" error
-        logger.error(f"Telethon authorization error during downloads: {ve}")
-        # Cannot proceed with downloads
+    except SessionPasswordNeededError:
+        logger.error("Telethon login failed: 2FA Password needed. Run script interactively first.")
+        # Cannot proceed without interactive password entry
+        return None, [], None
     except Exception as e:
-        logger.exception(f"Error during Telethon download phase: {e}")
-    # Download client automatically disconnected
+        logger.exception(f"Failed to initialize or run Telethon client: {e}")
+        return None, [], None
+    # The shared client stays connected for the next job; main.py disconnects
+    # it at shutdown via close_telethon_client().
 
-    # 5. Create ZIP Archive
-    zip_filename = f"chat_history_{chat_id_or_username}_{target_day}.zip"
-    # Sanitize chat_id_or_username if it's a string like '@channelname'
-    safe_chat_ref = re.sub(r'[^\w\-]+', '_', str(chat_id_or_username))
-    zip_filename = f"chat_history_{safe_chat_ref}_{target_day}.zip"
-    zip_filepath = archive_dir / zip_filename
 
-    logger.info(f"Creating archive: {zip_filepath}")
-    try:
-        with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zf:
-            messages_json_str = json.dumps(processed_data, indent=2, ensure_ascii=False)
-            zf.writestr("messages.json", messages_json_str)
-            logger.debug("Added messages.json to zip.")
-
-            # Add downloaded popular photos
-            for msg_id_f, info in downloaded_files_info.items():
-                local_path = info["local_path"]
-                zip_path = info["zip_path"]
-                if local_path.exists():
-                    zf.write(local_path, arcname=zip_path)
-                    logger.debug(f"Added {local_path} as {zip_path} to zip.")
-                else:
-                    logger.warning(f"File {local_path} for popular photo msg {msg_id_f} not found for zipping.")
+async def process_all_chats(
+    chat_ids,
+    cfg: ProcessingConfig,
+    target_date_override: datetime.date | None = None,
+    max_concurrent: int = 4,
+    ) -> dict:
+    """
+    Processes several chats concurrently with a bounded fan-out.
 
-        logger.info(f"Successfully created archive: {zip_filepath}")
-        return str(zip_filepath), popular_photo_paths
+    Each chat's pipeline is I/O-bound (history fetch, photo downloads), so
+    overlapping them recovers most of the serial wall time; the semaphore
+    keeps the fan-out within Telegram's tolerance.
 
-    except Exception as e:
-        logger.exception(f"Failed to create zip file {zip_filepath}: {e}")
-        # Return paths even if zip fails, but None for zip path
-        return None, popular_photo_paths
-    
\ No newline at end of file
+    Returns:
+        dict: chat id -> (path_to_zip_file or None, popular_photo_paths)
+    """
+    sem = asyncio.Semaphore(max_concurrent)
+
+    async def _one(chat_id):
+        async with sem:
+            return await process_chat_history(chat_id, cfg, target_date_override=target_date_override)
+
+    async with asyncio.TaskGroup() as tg:
+        tasks = {chat_id: tg.create_task(_one(chat_id)) for chat_id in chat_ids}
+    return {chat_id: task.result() for chat_id, task in tasks.items()}
@@ -7,16 +7,23 @@ import asyncio
 import configparser
 import logging
 import os
+import re
 import sys
 import datetime
-from functools import wraps
+from functools import lru_cache, wraps
+import gzip
 import json
-import zipfile
-import base64
+import pickle
 
 from pathlib import Path
 import html
-import requests
+
+
+# Optional, same fallback arrangement as bot_logic uses for messages.json.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from dotenv import load_dotenv
 from telegram import Update
@@ -27,11 +34,41 @@ import telegram.error # For error handling
 
 import bot_logic # Import our processing functions
 
+# uvloop swaps the default selector event loop for libuv's C implementation,
+# cutting per-call overhead on the TCP/TLS paths Telethon and PTB use heavily.
+# Linux/macOS only; fall through to the stdlib loop elsewhere.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # --- Dynamic Command Handler ---
-# Define the regex pattern to match commands starting with /process_history_
+# Pattern matching commands starting with /process_history_
 # (\w+) captures one or more alphanumeric characters (and underscore) as group 1
 # ^ anchors to the start, $ anchors to the end (important for commands)
-PROCESS_HISTORY_PATTERN = r'^/process_history_(\w+)$'
+# Precompiled: filters.Regex accepts the pattern object and skips recompiling.
+PROCESS_HISTORY_PATTERN = re.compile(r'^/process_history_(\w+)$')
+
+# Commands this bot knows, with an explicit boundary: without it the old
+# string pattern matched any prefix, so e.g. /start_foo was treated as known
+# and never reached unknown_command. The dynamic /process_history_<id> family
+# counts as known too — with arguments it misses the $-anchored dynamic
+# pattern and must not fall through to the unknown-command reply; its suffix
+# allows '-' so hand-typed raw negative ids (/process_history_-100...) count
+# too. Also accepts the /cmd@BotName form.
+_KNOWN_CMDS_RE = re.compile(r'^/(start|process_history(?:_[\w-]+)?|list_groupchats)(?:@\w+)?(?:\s|$)')
+
+# Fast probe for characters that actually need html.escape; bound once so the
+# listing loop pays a single C-level scan per title instead of a full escape.
+_NEEDS_ESC = re.compile(r'[<>&"\']').search
+
+# Composite message filters built once at import; the registration table in
+# main() reuses them instead of re-allocating the And/Inverted filter chains.
+_NONCMD_MESSAGE = filters.UpdateType.MESSAGE & (~filters.COMMAND)
+_GROUP_NONCMD = filters.ChatType.GROUPS & _NONCMD_MESSAGE
+_SUPERGROUP_NONCMD = filters.ChatType.SUPERGROUP & _NONCMD_MESSAGE
+_PRIVATE_NONCMD = filters.ChatType.PRIVATE & _NONCMD_MESSAGE
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -43,6 +80,35 @@ logging.getLogger("telethon").setLevel(logging.INFO) # Reduce library noise
 logger = logging.getLogger(__name__)
 
 # --- Load Configuration ---
+def _load_config_sections():
+    """Parses config.ini into plain per-section dicts, with a pickle cache.
+
+    The cache is keyed by the file's (mtime_ns, size), so supervised restarts
+    with an unchanged config.ini skip the INI tokenizer entirely. Only the
+    parsed sections are cached; everything derived from the environment is
+    rebuilt on every start.
+    """
+    cache_path = Path('config.ini.cache.pkl')
+    st = os.stat('config.ini')
+    key = (st.st_mtime_ns, st.st_size)
+
+    try:
+        cached = pickle.loads(cache_path.read_bytes())
+        if cached.get('key') == key:
+            return cached['sections']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        pass # Missing or stale cache; fall through to a full parse
+
+    parser = configparser.ConfigParser()
+    parser.read('config.ini')
+    sections = {name: dict(parser[name]) for name in parser.sections()}
+    try:
+        cache_path.write_bytes(pickle.dumps({'key': key, 'sections': sections},
+                                            protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        logger.warning("Could not write config cache: %s", e)
+    return sections
+
 def load_configuration():
     """Loads config from .env and config.ini"""
     load_dotenv() # Load .env file
@@ -56,9 +122,8 @@ def load_configuration():
         logger.critical("ADMINS_IDS not found in environment variables or .env file.")
         sys.exit(1)
 
-    config = configparser.ConfigParser()
     try:
-        config.read('config.ini')
+        config = _load_config_sections()
         # Basic validation
         # if 'Admins' not in config or 'admin_ids' not in config['Admins']:
         #     raise ValueError("Missing [Admins] section or admin_ids in config.ini")
@@ -71,10 +136,10 @@ def load_configuration():
 
         # Parse admin IDs into a set for efficient lookup
         # admin_id_str = config['Admins']['admin_ids']
-        admin_ids = {int(admin_id.strip()) for admin_id in admin_id_str.split(',') if admin_id.strip()}
+        admin_ids = frozenset(int(admin_id.strip()) for admin_id in admin_id_str.split(',') if admin_id.strip())
         config['Internal'] = {'admin_id_set': admin_ids} # Store parsed set
         # Get server_url safely with fallback to empty string
-        server_url = config.get('Processing', 'server_url', fallback='')
+        server_url = config['Processing'].get('server_url', '')
         if server_url:
             config['Internal']['HISTORY_ENDPOINT'] = server_url + '/process_history'
         else:
@@ -84,19 +149,40 @@ def load_configuration():
         logger.critical("Error loading or parsing config.ini: %s", e)
         sys.exit(1)
 
-    return dict(config) # Convert configparser to dict properly
+    return config # Plain dict of sections (see _load_config_sections)
 
 CONFIG = load_configuration()
 ADMIN_IDS = CONFIG['Internal']['admin_id_set']
 HISTORY_ENDPOINT = CONFIG['Internal']['HISTORY_ENDPOINT']
+BOT_TOKEN = CONFIG['Bot']['token']
+# Parse the processing settings once; every history run reuses this snapshot.
+PROCESSING_CFG = bot_logic.ProcessingConfig.from_config(CONFIG)
+# Typed once at startup: bad values (e.g. a non-numeric pause_time) fail here
+# with a clear message instead of mid-run, and the hot paths skip the dict
+# lookup + int() re-parse per use.
+PAUSE_TIME = int(CONFIG['Processing'].get('pause_time', 0))
+DOWNLOAD_DIR = Path(CONFIG['Processing'].get('download_dir', 'downloads'))
+# Off by default: the server must opt in by decompressing request bodies
+# (stock FastAPI doesn't), so compressed uploads are a deployment choice.
+GZIP_UPLOAD = CONFIG['Processing'].get('gzip_upload', 'false').strip().lower() in ('1', 'yes', 'true', 'on')
+
+# Caps concurrent /process_history jobs. Each job fans out a Telethon fetch,
+# photo downloads, zipping and an upload; several admins triggering it at once
+# would otherwise compete unbounded for memory, disk and the Telegram API.
+_PROCESSING_SEM = asyncio.Semaphore(int(CONFIG['Processing'].get('max_parallel_jobs', 2)))
 
 # --- Admin Check Decorator ---
+@lru_cache(maxsize=128)
+def _is_admin(user_id: int) -> bool:
+    """Memoized admin lookup; ADMIN_IDS never changes within a process."""
+    return user_id in ADMIN_IDS
+
 def admin_only(func):
     """Decorator to restrict command access to admins defined in config."""
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user = update.effective_user
-        if not user or str(user.id) not in ADMIN_IDS:
+        if not user or not _is_admin(user.id):
             logger.warning("Unauthorized access denied for user %d (%s)",
                            user.id, user.username or 'NoUsername')
             if update.message:
@@ -109,26 +195,112 @@ def admin_only(func):
 KNOWN_CHATS_FILE = Path("known_chats.json")
 KNOWN_CHATS = {} # Dictionary to store {chat_id: {"title": "...", "type": "..."}}
 
+# Cached title-sorted view of KNOWN_CHATS for /list_groupchats. Reset to None
+# at every mutation site and rebuilt lazily, so repeat listings skip the
+# O(N log N) sort (and its per-item .lower() allocations).
+_sorted_chats_cache = None
+
+# chat.id -> hash((title, type)) as last seen by track_chats. Lets the hottest
+# handler bail out on the common "known chat, unchanged" case with one int
+# compare instead of a KNOWN_CHATS lookup plus value indexing.
+_known_signature = {}
+
 def load_known_chats():
-    global KNOWN_CHATS
+    global KNOWN_CHATS, _sorted_chats_cache
+    _sorted_chats_cache = None
     if KNOWN_CHATS_FILE.exists():
         try:
-            with open(KNOWN_CHATS_FILE, 'r') as f:
-                # Ensure keys are integers after loading from JSON
-                KNOWN_CHATS = {k: v for k, v in json.load(f).items()}
-                logger.info(f"Loaded {len(KNOWN_CHATS)} known chats from file.")
-        except (json.JSONDecodeError, IOError) as e:
+            raw = KNOWN_CHATS_FILE.read_bytes()
+            loaded = orjson.loads(raw) if orjson is not None else json.loads(raw)
+            # Ensure keys are integers after loading from JSON (they come back
+            # as strings, which would never match the int chat.id and made
+            # every message re-add its chat and rewrite the file)
+            KNOWN_CHATS = {int(k): v for k, v in loaded.items()}
+            # Seed the fast-path map so the first message from a known chat
+            # doesn't trigger a redundant rewrite.
+            _known_signature.clear()
+            _known_signature.update(
+                (k, hash((v.get('title'), v.get('type')))) for k, v in KNOWN_CHATS.items()
+            )
+            logger.info(f"Loaded {len(KNOWN_CHATS)} known chats from file.")
+        except (ValueError, IOError) as e: # orjson/json decode errors are ValueErrors
             logger.error(f"Error loading known chats file: {e}")
             KNOWN_CHATS = {}
     else:
          KNOWN_CHATS = {}
 
-def save_known_chats():
+def _write_known_chats():
+    """Writes KNOWN_CHATS to disk atomically (tempfile + os.replace)."""
+    tmp_path = KNOWN_CHATS_FILE.with_suffix('.json.tmp')
     try:
-        with open(KNOWN_CHATS_FILE, 'w') as f:
-            json.dump(KNOWN_CHATS, f, indent=2)
+        if orjson is not None:
+            # NON_STR_KEYS: chat ids are ints (stdlib json coerces them silently)
+            tmp_path.write_bytes(orjson.dumps(
+                KNOWN_CHATS, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+            ))
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(KNOWN_CHATS, f, indent=2)
+        os.replace(tmp_path, KNOWN_CHATS_FILE)
     except IOError as e:
         logger.error(f"Error saving known chats file: {e}")
+        # Don't leave a half-written .tmp behind a failed replace.
+        tmp_path.unlink(missing_ok=True)
+
+# Set whenever KNOWN_CHATS changes; drained by the debounced flusher task.
+_known_chats_dirty = asyncio.Event()
+
+def save_known_chats():
+    """Requests persistence of KNOWN_CHATS.
+
+    Under the bot this only marks the data dirty; the background flusher
+    coalesces bursts of chat updates into a single disk write, so the handler
+    hot path never blocks the event loop on file I/O. Without a running loop
+    (CLI mode) it falls back to an immediate synchronous write.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        _write_known_chats()
+    else:
+        _known_chats_dirty.set()
+
+async def _flush_known_chats_loop():
+    """Debounced writer: one disk write per 5s burst of chat updates."""
+    while True:
+        await _known_chats_dirty.wait()
+        await asyncio.sleep(5) # Coalescing window
+        # Clear before writing: updates landing mid-write re-set the event
+        # and get picked up by the next round instead of being lost.
+        _known_chats_dirty.clear()
+        await asyncio.to_thread(_write_known_chats)
+
+# Handle to the running flusher; created in post_init, cancelled in
+# post_shutdown. Plain asyncio task, not Application.create_task: PTB only
+# tracks tasks created while the application is running, and post_init fires
+# before start(), so the PTB variant warns and never awaits the task.
+_flusher_task = None
+
+async def _start_known_chats_flusher(application):
+    """post_init hook: starts the background flusher once the loop exists."""
+    global _flusher_task
+    _flusher_task = asyncio.create_task(_flush_known_chats_loop())
+
+async def _flush_known_chats_on_shutdown(application):
+    """post_shutdown hook: stops the flusher, persists any update the debounce
+    window still holds and releases the shared upload and Telethon clients."""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+        _flusher_task = None
+    await _close_http()
+    await bot_logic.close_telethon_client()
+    if _known_chats_dirty.is_set():
+        _write_known_chats()
 
 
 
@@ -138,14 +310,19 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     user = update.effective_user # User who caused the update (if applicable)
 
-    logger.info(f"Chat update in {chat.id} ('{chat.title}') by user {user.id} ({user.username}): {update.effective_message.text}")
-
-    if not chat:
+    if chat is None:
         return # Should not happen for messages/chat member updates
-    
+
+    # user/effective_message can legitimately be None (e.g. channel posts);
+    # getattr keeps the log line from raising on them.
+    logger.info("Chat update in %s ('%s') by user %s (%s): %s",
+                chat.id, chat.title, getattr(user, 'id', None),
+                getattr(user, 'username', None),
+                getattr(update.effective_message, 'text', None))
+
     if chat.type == ChatType.PRIVATE:
-        logger.info(f"Skipping private chat {chat.id} ('{chat.title}')")
-        if update.effective_message.text:
+        logger.info("Skipping private chat %s ('%s')", chat.id, chat.title)
+        if update.effective_message and update.effective_message.text:
             if update.effective_message.text.startswith('/'):
                 result_message = "Your message looks like a command, but it isn't a valid command for me. Maybe a link is inside the text. Please use /start for help."
                 await context.bot.send_message(chat_id=chat.id, text=result_message)
@@ -155,11 +332,18 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         return
     
-    # Simplest: Update info on every message (can be slightly redundant)
-    if chat.id not in KNOWN_CHATS or KNOWN_CHATS[chat.id]['title'] != chat.title:
-        logger.info(f"Updating/adding chat {chat.id} ('{chat.title}', type: {chat.type}) to known list.")
-        KNOWN_CHATS[chat.id] = {"title": chat.title or f"Chat {chat.id}", "type": chat.type}
-        save_known_chats()
+    # Fast path: almost every message arrives from an already-known chat whose
+    # title and type haven't changed, which reduces to one int comparison.
+    sig = hash((chat.title, chat.type))
+    if _known_signature.get(chat.id) == sig:
+        return
+
+    global _sorted_chats_cache
+    logger.info("Updating/adding chat %s ('%s', type: %s) to known list.", chat.id, chat.title, chat.type)
+    KNOWN_CHATS[chat.id] = {"title": chat.title or f"Chat {chat.id}", "type": chat.type}
+    _known_signature[chat.id] = sig
+    _sorted_chats_cache = None
+    save_known_chats()
 
 async def track_my_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the bot being added or removed from a chat."""
@@ -170,17 +354,23 @@ async def track_my_membership(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat = my_member_update.chat
     new_status = my_member_update.new_chat_member.status
 
-    logger.info(f"Bot membership status changed in chat {chat.id} ('{chat.title}') to {new_status}")
-
-    if new_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR]:
-        if chat.id not in KNOWN_CHATS:
-            logger.info(f"Bot added to chat {chat.id} ('{chat.title}', type: {chat.type}). Adding to list.")
-            KNOWN_CHATS[chat.id] = {"title": chat.title or f"Chat {chat.id}", "type": chat.type}
+    logger.info("Bot membership status changed in chat %s ('%s') to %s", chat.id, chat.title, new_status)
+
+    global _sorted_chats_cache
+    if new_status in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR):
+        # setdefault folds the membership test and insert into one hash probe;
+        # identity tells us whether our entry actually went in.
+        entry = {"title": chat.title or f"Chat {chat.id}", "type": chat.type}
+        if KNOWN_CHATS.setdefault(chat.id, entry) is entry:
+            logger.info("Bot added to chat %s ('%s', type: %s). Adding to list.", chat.id, chat.title, chat.type)
+            _known_signature[chat.id] = hash((chat.title, chat.type))
+            _sorted_chats_cache = None
             save_known_chats()
-    elif new_status in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]:
-         if chat.id in KNOWN_CHATS:
-            logger.info(f"Bot removed from chat {chat.id}. Removing from list.")
-            del KNOWN_CHATS[chat.id]
+    elif new_status in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED):
+        if KNOWN_CHATS.pop(chat.id, None) is not None:
+            logger.info("Bot removed from chat %s. Removing from list.", chat.id)
+            _known_signature.pop(chat.id, None)
+            _sorted_chats_cache = None
             save_known_chats()
 
 @admin_only # Assuming you have the admin_only decorator from the previous example
@@ -192,45 +382,52 @@ async def list_groupchats_command(update: Update, context: ContextTypes.DEFAULT_
         return
 
     message_lines = ["<b>Chats I'm aware of:</b>"] # Start with HTML bold
-
-    # Sort by title for better readability, handling cases where title might be missing
-    sorted_chats = sorted(
-        KNOWN_CHATS.items(),
-        key=lambda item: item[1].get('title', f'Unknown Chat {item[0]}').lower()
-    )
+    # Telegram caps messages at 4096 chars; track the running size so the
+    # truncation decision is made per entry while building, not by scanning
+    # a fully-joined oversized string afterwards. 4050 leaves headroom for
+    # the truncation notice.
+    size = len(message_lines[0])
+    truncated = False
+
+    # Sort by title for better readability, handling cases where title might be missing.
+    # The sorted view is cached and only rebuilt after KNOWN_CHATS changes.
+    global _sorted_chats_cache
+    if _sorted_chats_cache is None:
+        _sorted_chats_cache = sorted(
+            KNOWN_CHATS.items(),
+            key=lambda item: item[1].get('title', f'Unknown Chat {item[0]}').lower()
+        )
+    sorted_chats = _sorted_chats_cache
 
     for chat_id, info in sorted_chats:
-        # Safely get title and escape any HTML special characters in it
-        title = html.escape(info.get('title', f'Unknown Chat {chat_id}'))
+        # Safely get the title; escape only when it actually contains HTML
+        # special characters (rare for chat titles), skipping html.escape's
+        # replace chain for the common plain case.
+        title = info.get('title') or f'Unknown Chat {chat_id}'
+        if _NEEDS_ESC(title):
+            title = html.escape(title)
         chat_type = info.get('type', '?')
 
         # Create the command string for this chat
-        if chat_id[0] == '-':
-            command_string = f"/process_history__minus_{chat_id[1:]}"
+        if chat_id < 0:
+            command_string = f"/process_history__minus_{-chat_id}"
         else:
             command_string = f"/process_history_{chat_id}"
 
-        # # Format the line using HTML. <code> makes it easy to click/copy.
-        # line = (
-        #     f"- {title} (ID: <code>{chat_id}</code>, Type: {chat_type})\n"
-        #     f"  └ Run Process: <code>{command_string}</code>"
-        # )
-
         # Format the line using HTML. <code> makes it easy to click/copy.
         line = (
             f"- {title} (ID: {chat_id}, Type: {chat_type})\n"
             f"  └ Run Process: {command_string}"
-        )        
+        )
+        if size + 1 + len(line) > 4050: # +1 for the joining newline
+            truncated = True
+            break
         message_lines.append(line)
+        size += 1 + len(line)
 
     full_message = "\n".join(message_lines)
-
-    # Handle potential message length limits (Telegram limit is 4096 chars)
-    if len(full_message) > 4096:
-        # Find a good place to truncate (e.g., before the last entry's start)
-        cutoff_point = full_message.rfind('\n-', 0, 4050) # Find last '-' entry start before limit
-        if cutoff_point == -1: cutoff_point = 4050 # Fallback if no entry found
-        full_message = full_message[:cutoff_point] + "\n\n<b>... (list truncated due to length)</b>"
+    if truncated:
+        full_message += "\n\n<b>... (list truncated due to length)</b>"
 
     # Send the message using HTML parse mode
     # await update.message.reply_text(full_message, parse_mode='HTML')
@@ -272,47 +469,53 @@ async def process_history_command(update: Update, context: ContextTypes.DEFAULT_
 
     if args:
         # Arguments were provided
-        target_chat_id = args[0]
         try:
             target_chat_id = int(args[0])
         except ValueError:
             target_chat_id = args[0]
-            
-        logger.info(f"Admin {user_id} requested processing for specific chat ID: {target_chat_id}")
-        await update.message.reply_text(
-            f"Processing request for yesterday's history in chat ID: {target_chat_id}..."
-            f"\n(I'll send results back here in chat {feedback_chat_id})."
-        )
 
         if len(args) > 1:
-            # Additional arguments were provided, assume it's a date
-            target_date = args[1]
+            # Additional arguments were provided, assume it's a date.
+            # Validate before the first status reply: a bad date used to fall
+            # through into processing as a raw str after the error message.
+            # fromisoformat is also a C fast-path, unlike strptime.
             try:
-                target_date = datetime.datetime.strptime(target_date, "%Y-%m-%d").date()
+                target_date = datetime.date.fromisoformat(args[1])
             except ValueError:
                 await update.message.reply_text(
-                    f"Error: Invalid date format '{target_date}'. Use YYYY-MM-DD."
+                    f"Error: Invalid date format '{args[1]}'. Use YYYY-MM-DD."
                 )
+                return
+
+        logger.info("Admin %s requested processing for specific chat ID: %s", user_id, target_chat_id)
+        await update.message.reply_text(
+            f"Processing request for yesterday's history in chat ID: {target_chat_id}..."
+            f"\n(I'll send results back here in chat {feedback_chat_id})."
+        )
 
     else:
         # No arguments, use the current chat
         target_chat_id = chat_where_command_was_sent
-        logger.info(f"Admin {user_id} initiated history processing for current chat {target_chat_id}")
+        logger.info("Admin %s initiated history processing for current chat %s", user_id, target_chat_id)
         await update.message.reply_text(
              f"Processing request for yesterday's history in this chat (ID: {target_chat_id})..."
         )
 
     # --- Core Logic Execution ---
-    if target_chat_id:
-        processing_task = asyncio.create_task(
-            bot_logic.process_chat_history(target_chat_id, CONFIG, target_date_override=target_date)
-        )
-        # Wait for the task to complete
+    if not target_chat_id:
+        return
+
+    # Queue behind at most max_parallel_jobs running history jobs; requests
+    # beyond the cap wait here instead of fanning out unbounded.
+    async with _PROCESSING_SEM:
         try:
-            zip_filepath, popular_photos = await processing_task
+            # Await the coroutine directly: nothing runs concurrently with it
+            # here, so the create_task wrapper only added a Task allocation,
+            # a scheduler round-trip and a wrapped traceback.
+            zip_filepath, popular_photos, json_bytes = await bot_logic.process_chat_history(
+                target_chat_id, PROCESSING_CFG, target_date_override=target_date
+            )
             # --- Sending Results Back ---
-            result_message = f"Telethon processing complete for chat: {target_chat_id}.\n"
-
             result_message = f"Processing complete for chat ID {target_chat_id}.\n"
             if zip_filepath:
                 result_message += f"- Archive created: See below.\n"
@@ -320,8 +523,12 @@ async def process_history_command(update: Update, context: ContextTypes.DEFAULT_
                 result_message += f"- Archive creation failed or no messages processed.\n"
 
             if popular_photos:
-                result_message += f"- Found {len(popular_photos)} popular photos (saved locally on the server):\n"
-                result_message += "\n".join([f"  - {os.path.basename(p)}" for p in popular_photos])
+                # Join on the separator with a generator: one basename per
+                # path, no per-item f-string or throwaway list.
+                result_message += (
+                    f"- Found {len(popular_photos)} popular photos (saved locally on the server):\n"
+                    "  - " + "\n  - ".join(os.path.basename(p) for p in popular_photos)
+                )
             else:
                 result_message += "- No photos in the chat history met the reaction criteria."
 
@@ -330,22 +537,23 @@ async def process_history_command(update: Update, context: ContextTypes.DEFAULT_
 
             if zip_filepath and os.path.exists(zip_filepath):
                 try:
-                    # Send the document to the chat where the command was issued
+                    # Send the document to the chat where the command was issued.
+                    # Passing a Path lets PTB stream the file with its own async
+                    # I/O instead of blocking the event loop on a sync open/read
+                    # (and closes the handle properly on error paths).
                     await context.bot.send_document(
-                        chat_id=feedback_chat_id, document=open(zip_filepath, 'rb')
+                        chat_id=feedback_chat_id, document=Path(zip_filepath)
                     )
 
-                    # Read the JSON from the zip file
-                    with zipfile.ZipFile(zip_filepath, 'r') as zip_ref:
-                        with zip_ref.open('messages.json') as json_file:
-                            json_data = json_file.read().decode('utf-8')
-                    
-                    # Send raw JSON to server
-                    picture_file = send_raw_history_to_server(HISTORY_ENDPOINT, json_data)
+                    # Upload the same JSON bytes that went into the archive —
+                    # no need to reopen the zip and inflate messages.json.
+                    picture_file = await send_raw_history_to_server(HISTORY_ENDPOINT, json_bytes)
 
                     if picture_file:
+                        # Pass the path, not an open handle: PTB reads the
+                        # file itself and we don't leak the descriptor.
                         await context.bot.send_photo(
-                            chat_id=feedback_chat_id, photo=open(picture_file, 'rb')
+                            chat_id=feedback_chat_id, photo=picture_file
                         )
                     else:
                         await context.bot.send_message(
@@ -393,7 +601,7 @@ async def process_history_dynamic(update: Update, context: ContextTypes.DEFAULT_
     /process_history_<target_chat_id_or_name>_<date>    
     """
     message_text = update.message.text
-    logger.info(f"Received dynamic command attempt: {message_text}")
+    logger.info("Received dynamic command attempt: %s", message_text)
 
     # The regex match object is often stored in context.matches by the Regex filter
     # context.matches is a list of match objects, one for each filter that matched.
@@ -402,7 +610,7 @@ async def process_history_dynamic(update: Update, context: ContextTypes.DEFAULT_
 
     if match:
         dynamic_part = match.group(1) # Extract the part captured by (\w+)
-        logger.info(f"Extracted dynamic part: {dynamic_part}")
+        logger.info("Extracted dynamic part: %s", dynamic_part)
         dynamic_part = dynamic_part.replace('_minus_', '-') # Handle the special case for negative IDs
         await update.message.reply_text(f'Processing history for identifier: {dynamic_part}')
         if not context.args:
@@ -414,67 +622,99 @@ async def process_history_dynamic(update: Update, context: ContextTypes.DEFAULT_
         logger.warning("Dynamic handler called but no regex match found in context.")
         await update.message.reply_text("Something went wrong processing the dynamic command.")
 
-def send_raw_history_to_server(history_endpoint, json_string_data):
-    """Sends the raw JSON string to the FastAPI server."""
-    if not json_string_data:
-        logger.info("No JSON string data to send.")
+# Client reused across uploads: keep-alive skips the DNS + TCP + TLS
+# handshake that a one-shot request pays on every call to the same server.
+# Created lazily on first use — see send_raw_history_to_server.
+_HTTP = None
+
+def _save_image(filepath, image_b64):
+    """Decodes and writes a server-returned image. Blocking; run via to_thread."""
+    # Deferred like httpx below: only paid when a server actually returns
+    # an image, not on every bot/CLI start.
+    import base64
+    with open(filepath, 'wb') as f:
+        f.write(base64.b64decode(image_b64))
+
+async def _close_http():
+    """Closes the shared upload client (bot shutdown / CLI teardown)."""
+    global _HTTP
+    if _HTTP is not None:
+        await _HTTP.aclose()
+        _HTTP = None
+
+async def send_raw_history_to_server(history_endpoint, json_bytes):
+    """Sends raw JSON bytes to the FastAPI server.
+
+    Fully async via httpx (already a python-telegram-bot dependency), so the
+    event loop keeps serving other updates during the upload and the LLM
+    processing behind it — previously the synchronous requests call had to be
+    pushed into a worker thread to avoid stalling the bot for up to 90s.
+    """
+    # Imported here so a polling process that never uploads (server_url empty)
+    # doesn't reference it at startup; httpx itself is already loaded by PTB.
+    import httpx
+    global _HTTP
+    if _HTTP is None:
+        _HTTP = httpx.AsyncClient(
+            # Accurate even though the server treats the body as raw text
+            headers={'Content-Type': 'application/json; charset=utf-8'},
+            timeout=90, # Generous: covers large data + LLM processing
+        )
+
+    if json_bytes is None:
+        logger.info("No JSON data to send.")
         return
 
-    logger.info(f"Sending raw JSON string to {history_endpoint}")
+    logger.info("Sending raw JSON to %s", history_endpoint)
     response = None
-    # Set the Content-Type header explicitly to indicate it's JSON data
-    # Even though the server treats it as raw text, this is accurate
-    headers = {'Content-Type': 'application/json; charset=utf-8'}
 
     try:
-        # Use the 'data' parameter to send raw bytes
-        # Encode the Python string to UTF-8 bytes before sending
-        response = requests.post(
-            history_endpoint,
-            data=json_string_data.encode('utf-8'), # Crucial: encode string to bytes
-            headers=headers,
-            timeout=90 # Increase timeout for potentially large data + LLM processing
-        )
+        if GZIP_UPLOAD:
+            # A day of chat history compresses ~10x; for multi-MB archives the
+            # CPU spent on level-6 gzip is far cheaper than pushing the bytes.
+            compressed = await asyncio.to_thread(gzip.compress, json_bytes, 6)
+            response = await _HTTP.post(history_endpoint, content=compressed,
+                                        headers={'Content-Encoding': 'gzip'})
+        else:
+            response = await _HTTP.post(history_endpoint, content=json_bytes)
 
         # Check the response status code
         response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
 
-        logger.info(f"Success! Server responded with status code {response.status_code}")
-        # Process the response from the server
+        logger.info("Success! Server responded with status code %s", response.status_code)
+        # Process the response from the server. The reply may embed a ~MB
+        # base64 PNG, where orjson's C parser beats stdlib json several-fold.
         try:
-            result = response.json()
-            # logger.info("Server response: %s", json.dumps(result, indent=2, ensure_ascii=False))
-            
+            result = orjson.loads(response.content) if orjson is not None else response.json()
+
             # Extract and save image if it exists in the response
             if 'image_base64' in result:
-                
+
                 # Create downloads directory if it doesn't exist
-                downloads_dir = Path(CONFIG['Processing']['download_dir'])
-                downloads_dir.mkdir(parents=True, exist_ok=True)
-                
+                DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+
                 # Generate filename from name field or use timestamp
                 filename = f'image_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.png'
-                filepath = downloads_dir.joinpath(filename)
-                
-                # Decode and save the image
-                image_data = base64.b64decode(result['image_base64'])
-                with open(filepath, 'wb') as f:
-                    f.write(image_data)
-                
-                logger.info(f"Saved image to: {filepath}")
+                filepath = DOWNLOAD_DIR.joinpath(filename)
+
+                # Decode and save the image off the loop — for a ~MB PNG the
+                # base64 decode plus write is real blocking work.
+                await asyncio.to_thread(_save_image, filepath, result['image_base64'])
+
+                logger.info("Saved image to: %s", filepath)
 
                 return filepath # Return the path to the saved image
 
-        except json.JSONDecodeError:
+        except ValueError: # Covers both orjson and stdlib json decode errors
             logger.warning("Server response was not valid JSON. Raw response text: %s", response.text)
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending request to the history processing server: {e}")
+    except httpx.HTTPError as e:
+        logger.error("Error sending request to the history processing server: %s", e)
         # More specific error details if available (e.g., connection error, timeout)
         if response is not None:
-            logger.error(f"Raw Response Text (if any): {response.text}")
+            logger.error("Raw Response Text (if any): %s", response.text)
     except Exception as e:
-        logger.error(f"An unexpected error occurred during the request: {e}")
+        logger.error("An unexpected error occurred during the request: %s", e)
 
 # --- CLI Handling ---
 async def run_cli_processing(args):
@@ -487,22 +727,40 @@ async def run_cli_processing(args):
         target_date = None
         if args.date:
             try:
-                target_date = datetime.datetime.strptime(args.date, "%Y-%m-%d").date()
+                target_date = datetime.date.fromisoformat(args.date)
             except ValueError:
                 logger.error(f"Invalid date format '{args.date}'. Use YYYY-MM-DD.")
                 sys.exit(1)
 
-        for chat_id in KNOWN_CHATS.keys():
+        chat_ids = list(KNOWN_CHATS.keys())
+
+        concurrency = max(1, getattr(args, 'concurrency', 1))
+        if concurrency > 1:
+            # Bounded fan-out: each chat's pipeline is I/O-bound, so a few in
+            # flight overlap nicely. The semaphore replaces the inter-chat
+            # pause as the throttle on the LLM server.
+            sem = asyncio.Semaphore(concurrency)
+
+            async def _one(chat_id):
+                async with sem:
+                    logger.info(f"Processing chat ID: {chat_id}")
+                    return await process_history_chatid(chat_id, target_date)
+
+            await asyncio.gather(*(_one(chat_id) for chat_id in chat_ids))
+            return
+
+        # Sequential path (default). Snapshot the ids once and track the
+        # index: the old code rebuilt list(KNOWN_CHATS.keys()) on every
+        # iteration just to test for the last element (O(N^2) overall), and
+        # compared it against a chat_id that had been reassigned to int.
+        last_idx = len(chat_ids) - 1
+        for i, chat_id in enumerate(chat_ids):
             logger.info(f"Processing chat ID: {chat_id}")
-            try:
-                chat_id = int(chat_id) # Ensure chat_id is an integer
-            except ValueError:
-                pass
             history_found_and_processed = await process_history_chatid(chat_id, target_date)
-            if history_found_and_processed and chat_id != list(KNOWN_CHATS.keys())[-1]:
-                pause = int(CONFIG['Processing']['pause_time']) # Pause between each chat processing to avoid overwhelming the LLM server
-                logger.info(f"Pausing for {pause} seconds before processing the next chat...")
-                await asyncio.sleep(pause)
+            if history_found_and_processed and i != last_idx:
+                # Pause between chats to avoid overwhelming the LLM server.
+                logger.info(f"Pausing for {PAUSE_TIME} seconds before processing the next chat...")
+                await asyncio.sleep(PAUSE_TIME)
         return
     else:
         if not args.chat_id:
@@ -518,7 +776,7 @@ async def run_cli_processing(args):
         target_date = None
         if args.date:
             try:
-                target_date = datetime.datetime.strptime(args.date, "%Y-%m-%d").date()
+                target_date = datetime.date.fromisoformat(args.date)
             except ValueError:
                 logger.error(f"Invalid date format '{args.date}'. Use YYYY-MM-DD.")
                 sys.exit(1)
@@ -531,8 +789,8 @@ async def process_history_chatid(target_chat_entity, target_date=None):
     logger.info(f"Processing history for chat ID: {target_chat_entity} on date: {target_date or 'yesterday'}")
     try:
         # Directly call the bot_logic function which now uses Telethon
-        zip_filepath, popular_photos = await bot_logic.process_chat_history(
-            target_chat_entity, CONFIG, target_date_override=target_date
+        zip_filepath, popular_photos, json_bytes = await bot_logic.process_chat_history(
+            target_chat_entity, PROCESSING_CFG, target_date_override=target_date
         )
 
 
@@ -550,13 +808,8 @@ async def process_history_chatid(target_chat_entity, target_date=None):
             logger.info("- No photos met the reaction criteria.")
 
         if zip_filepath and os.path.exists(zip_filepath):
-            # Read the JSON from the zip file
-            with zipfile.ZipFile(zip_filepath, 'r') as zip_ref:
-                with zip_ref.open('messages.json') as json_file:
-                    json_data = json_file.read().decode('utf-8')
-            
-            # Send raw JSON to server
-            send_raw_history_to_server(HISTORY_ENDPOINT, json_data)
+            # Same bytes that went into the archive; no re-extraction needed.
+            await send_raw_history_to_server(HISTORY_ENDPOINT, json_bytes)
             return True # Successfully processed and sent to server
         else:
             return False # No zip file created or not found
@@ -589,42 +842,70 @@ def main():
         action="store_true",
         help="Process all known chats (CLI mode only)."
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Chats to process in parallel with --process-known-chats "
+             "(default 1: sequential with pauses between chats)."
+    )
     args = parser.parse_args()
     load_known_chats() # Load known chats at startup
 
     if args.cli:
-        # Run the CLI part using asyncio
-        asyncio.run(run_cli_processing(args))
+        # Run the CLI part using asyncio, closing the shared upload and
+        # Telethon clients before the loop goes away.
+        async def _cli_main():
+            try:
+                await run_cli_processing(args)
+            finally:
+                await _close_http()
+                await bot_logic.close_telethon_client()
+        asyncio.run(_cli_main())
     else:
         # Run the bot
         logger.info("Starting Telegram bot...")
         defaults = Defaults()
         application = (
             ApplicationBuilder()
-            .token(CONFIG['Bot']['token'])
+            .token(BOT_TOKEN)
             .defaults(defaults)
+            # Dispatch updates concurrently: a long /process_history job
+            # (Telethon fetch + zip + LLM round-trip) must not serialize
+            # every other incoming command behind it. Outbound LLM load is
+            # still capped by _PROCESSING_SEM.
+            .concurrent_updates(True)
+            # A larger Bot-API connection pool with longer timeouts so
+            # parallel send_document/send_photo calls for multi-MB archives
+            # don't contend for PTB's default small pool.
+            .connection_pool_size(16)
+            .pool_timeout(30)
+            .read_timeout(60)
+            .write_timeout(60)
+            .post_init(_start_known_chats_flusher)
+            .post_shutdown(_flush_known_chats_on_shutdown)
             .build()
         )
 
-        # Register handlers
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("process_history", process_history_command))
-        application.add_handler(CommandHandler("list_groupchats", list_groupchats_command))
-        
-        # Dynamic command handler using MessageHandler and Regex filter
-        # It filters for COMMAND type messages that ALSO match the regex pattern
-        application.add_handler(MessageHandler(
-            filters.COMMAND & filters.Regex(PROCESS_HISTORY_PATTERN),
-            process_history_dynamic
-        ))        
-        # Handle unknown commands
-        application.add_handler(MessageHandler(filters.COMMAND & (~filters.Regex(r'^/(start|process_history|list_groupchats)')), unknown_command))
-        
-        application.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & (~filters.COMMAND), track_chats))
-        application.add_handler(MessageHandler(filters.ChatType.SUPERGROUP & filters.UpdateType.MESSAGE & (~filters.COMMAND), track_chats))
-        application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.UpdateType.MESSAGE & (~filters.COMMAND), track_chats))
-        application.add_handler(ChatMemberHandler(track_my_membership, ChatMemberHandler.MY_CHAT_MEMBER))
-        # Add other handlers if needed (e.g., /start, /help)
+        # Register handlers; registration order matters (first match wins for
+        # message handlers), so keep the command/dynamic/unknown sequence.
+        handlers = (
+            CommandHandler("start", start),
+            CommandHandler("process_history", process_history_command),
+            CommandHandler("list_groupchats", list_groupchats_command),
+            # Dynamic command handler: COMMAND messages that ALSO match the pattern
+            MessageHandler(filters.COMMAND & filters.Regex(PROCESS_HISTORY_PATTERN),
+                           process_history_dynamic),
+            # Handle unknown commands
+            MessageHandler(filters.COMMAND & (~filters.Regex(_KNOWN_CMDS_RE)),
+                           unknown_command),
+            MessageHandler(_GROUP_NONCMD, track_chats),
+            MessageHandler(_SUPERGROUP_NONCMD, track_chats),
+            MessageHandler(_PRIVATE_NONCMD, track_chats),
+            ChatMemberHandler(track_my_membership, ChatMemberHandler.MY_CHAT_MEMBER),
+        )
+        for handler in handlers:
+            application.add_handler(handler)
         application.add_error_handler(error_handler)
 
         # Start the Bot